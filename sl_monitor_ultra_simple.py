@@ -5,23 +5,102 @@ Kollar om linje 29 nämns på SL:s störningssida
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
 import json
 import os
+import re
+import hashlib
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import time
 
+try:
+    import orjson  # Snabbare JSON (valfritt)
+except ImportError:
+    orjson = None
+
 # Konfiguration
 LINE_TO_MONITOR = "29"
 LINE_NAME = "Näsbyparkslinjen"
 STATE_FILE = Path(__file__).parent / "sl_state.json"
 
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Connection": "keep-alive"
+}
+
+POLL_SECONDS = 600  # Samma takt som cron-schemat i workflowen (*/10)
+FAILURES_BEFORE_PAUSE = 3  # Så många fel i rad innan kontroller hoppas över
+MAX_BACKOFF_SECONDS = 3600  # Längsta paus efter upprepade fel
+CONTEXT_BYTES = 200  # Hur mycket text runt ett omnämnande som tas med
+
+def _bytes_pattern(pattern):
+    """Kompilera ett skiftlägesokänsligt mönster som körs direkt på sidans UTF-8-bytes"""
+    # re.IGNORECASE på bytes hanterar bara ASCII, så å/ä/ö skrivs ut i båda formerna
+    for lower, upper in (("å", "Å"), ("ä", "Ä"), ("ö", "Ö")):
+        pattern = pattern.replace(lower, f"(?:{lower}|{upper})")
+    return re.compile(pattern.encode("utf-8"), re.IGNORECASE)
+
+def _parse_retry_after(value):
+    """Tolka en Retry-After-header (sekunder eller HTTP-datum) till sekunder"""
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+LINE_WORDS = rf"linje ?{LINE_TO_MONITOR}(?!\d)| {LINE_TO_MONITOR} |näsbypark"
+DISRUPTION_WORDS = r"störning|förseningar|inställd|ersättningsbuss|trafik|problem|avbrott"
+
+# Förkompilerade mönster (ingen avkodning eller .lower()-kopia av sidan behövs)
+SCAN_PATTERN = _bytes_pattern(rf"(?P<line>{LINE_WORDS})|(?P<disruption>{DISRUPTION_WORDS})")
+LINE_PATTERN = _bytes_pattern(LINE_WORDS)
+DISRUPTION_PATTERN = _bytes_pattern(DISRUPTION_WORDS)
+# Matchar "29" men inte t.ex. "129", "291" eller "2029"
+MENTION_PATTERN = _bytes_pattern(rf"(?<!\d){LINE_TO_MONITOR}(?!\d)|näsbypark")
+
 class SLMonitorUltraSimple:
-    def __init__(self):
+    def __init__(self, poll_seconds=POLL_SECONDS):
         self.url = "https://sl.se/reseplanering/trafiklaget"
+        
+        # Återanvänd anslutningen (keep-alive) mellan anrop
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            # Bara snabba omförsök: inga omförsök vid läs-timeout och inga omförsök på
+            # 429/503 - de ber oss vänta (Retry-After), vilket skip_until sköter istället
+            max_retries=Retry(
+                total=3,
+                connect=2,
+                read=False,  # Inga omförsök - ursprungliga Timeout-felet släpps igenom
+                status=2,
+                backoff_factor=0.5,
+                status_forcelist=[502, 504],
+                respect_retry_after_header=False,
+                raise_on_status=False
+            )
+        ))
+        self.session.headers.update(HTTP_HEADERS)
+        # gzip/deflate, plus br när brotli finns installerat (annars kan svaret inte avkodas)
+        self.session.headers.update(make_headers(accept_encoding=True))
+        
+        # Tid mellan kontroller - pausen efter fel räknas i hela kontroller
+        self.poll_seconds = poll_seconds
+        
+        # Sekunder som SL bad oss vänta (Retry-After) vid senaste misslyckade hämtning
+        self.retry_after = None
+        
+        # SMTP-anslutningen öppnas vid första email och återanvänds sedan
+        self._smtp = None
     
     def log(self, message):
         """Logga meddelanden (bara print i denna version)"""
@@ -29,57 +108,104 @@ class SLMonitorUltraSimple:
         log_message = f"[{timestamp}] {message}"
         print(log_message)
     
-    def check_for_disruptions(self):
+    def check_for_disruptions(self, previous_state=None):
         """Kolla om linje 29 har störningar genom att hämta hemsidan"""
+        previous_state = previous_state or {}
+        self.retry_after = None
         try:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-            }
+            headers = {}
+            
+            # Villkorlig hämtning - SL svarar 304 om sidan inte ändrats
+            if previous_state.get("etag"):
+                headers["If-None-Match"] = previous_state["etag"]
+            if previous_state.get("last_modified"):
+                headers["If-Modified-Since"] = previous_state["last_modified"]
             
             self.log("Hämtar SL:s störningssida...")
-            response = requests.get(self.url, headers=headers, timeout=15)
+            response = self.session.get(self.url, headers=headers, timeout=(5, 15))
+            
+            cache = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }
+            
+            if response.status_code == 304:
+                # Ett 304-svar behöver inte upprepa validatorerna - behåll de sparade
+                cache["etag"] = cache["etag"] or previous_state.get("etag")
+                cache["last_modified"] = cache["last_modified"] or previous_state.get("last_modified")
+                cache["body_hash"] = previous_state.get("body_hash")
+                self.log("♻️ Sidan oförändrad sedan förra kontrollen")
+                return {
+                    "has_disruption": previous_state.get("had_disruption", False),
+                    "timestamp": datetime.now().isoformat(),
+                    "cache": cache
+                }
             
             if response.status_code != 200:
                 self.log(f"⚠️ Hemsidan svarade med status {response.status_code}")
+                self.retry_after = _parse_retry_after(response.headers.get("Retry-After"))
                 return None
             
-            content = response.text.lower()
+            # Samma innehåll som förra gången? Då behövs ingen ny analys
+            cache["body_hash"] = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+            if cache["body_hash"] == previous_state.get("body_hash"):
+                self.log("♻️ Sidans innehåll oförändrat sedan förra kontrollen")
+                return {
+                    "has_disruption": previous_state.get("had_disruption", False),
+                    "timestamp": datetime.now().isoformat(),
+                    "cache": cache
+                }
+            
+            raw = response.content
             
             # Kolla om linje 29 eller Näsbyparkslinjen nämns
-            has_line_29 = "linje 29" in content or " 29 " in content or "linje29" in content
-            has_nasbyparken = "näsbypark" in content
-            has_disruption_words = any(word in content for word in [
-                "störning", "förseningar", "inställd", "ersättningsbuss", 
-                "trafik", "problem", "avbrott"
-            ])
+            # Ett gemensamt svep hittar det som kommer först, sedan letas bara efter det andra
+            has_line_29 = has_disruption_words = False
+            first = SCAN_PATTERN.search(raw)
+            if first is not None:
+                if first.lastgroup == "line":
+                    has_line_29 = True
+                    has_disruption_words = DISRUPTION_PATTERN.search(raw, first.end()) is not None
+                else:
+                    has_disruption_words = True
+                    has_line_29 = LINE_PATTERN.search(raw, first.end()) is not None
             
             # Om linje 29 nämns OCH det finns störningsord i närheten
-            if (has_line_29 or has_nasbyparken) and has_disruption_words:
+            if has_line_29 and has_disruption_words:
                 self.log(f"⚠️ Linje {LINE_TO_MONITOR} kan ha störningar (nämns på sidan)")
                 
                 # Försök hitta kontexten där linje 29 nämns
-                lines = content.split('\n')
                 relevant_context = []
+                covered_until = 0
+                view = memoryview(raw)  # Utdrag utan att kopiera bytes
                 
-                for i, line in enumerate(lines):
-                    if "29" in line or "näsbypark" in line:
-                        # Ta lite kontext runt omnämnandet
-                        context_start = max(0, i - 2)
-                        context_end = min(len(lines), i + 3)
-                        context = ' '.join(lines[context_start:context_end])
-                        if len(context) > 50:  # Bara om det är meningsfullt
-                            relevant_context.append(context[:300])
+                for match in MENTION_PATTERN.finditer(raw):
+                    # Omnämnanden inom förra utdraget ger bara en dubblett
+                    if match.start() < covered_until:
+                        continue
+                    
+                    # Ta lite kontext runt omnämnandet
+                    snippet_end = match.end() + CONTEXT_BYTES
+                    snippet = view[max(0, match.start() - CONTEXT_BYTES):snippet_end]
+                    context = ' '.join(str(snippet, "utf-8", "ignore").split())
+                    if len(context) > 50:  # Bara om det är meningsfullt
+                        relevant_context.append(context[:300])
+                        covered_until = snippet_end
+                        if len(relevant_context) == 2:
+                            break
                 
                 return {
                     "has_disruption": True,
-                    "context": relevant_context[:2] if relevant_context else ["Störning upptäckt"],
-                    "timestamp": datetime.now().isoformat()
+                    "context": relevant_context or ["Störning upptäckt"],
+                    "timestamp": datetime.now().isoformat(),
+                    "cache": cache
                 }
             else:
                 self.log(f"✅ Linje {LINE_TO_MONITOR} nämns inte bland störningar")
                 return {
                     "has_disruption": False,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": datetime.now().isoformat(),
+                    "cache": cache
                 }
                 
         except requests.exceptions.Timeout:
@@ -96,23 +222,64 @@ class SLMonitorUltraSimple:
         """Ladda tidigare tillstånd från fil"""
         try:
             if STATE_FILE.exists():
-                with open(STATE_FILE, "r", encoding="utf-8") as f:
-                    return json.load(f)
+                data = STATE_FILE.read_bytes()
+                return orjson.loads(data) if orjson else json.loads(data)
         except Exception as e:
             self.log(f"⚠️ Kunde inte läsa tidigare tillstånd: {e}")
         return {"had_disruption": False}
     
-    def save_state(self, has_disruption):
-        """Spara nuvarande tillstånd till fil"""
+    def save_state(self, has_disruption, cache=None, previous_state=None):
+        """Spara nuvarande tillstånd (och HTTP-cacheinfo) till fil"""
         state = {
             "timestamp": datetime.now().isoformat(),
             "had_disruption": has_disruption
         }
+        state.update(cache or {})
+        
+        # Hoppa över skrivningen om inget har ändrats
+        if previous_state is not None:
+            unchanged = {k: v for k, v in state.items() if k != "timestamp"} == \
+                        {k: v for k, v in previous_state.items() if k != "timestamp"}
+            if unchanged:
+                return
         
+        self._write_state(state)
+    
+    def record_failure(self, previous_state):
+        """Räkna misslyckade hämtningar och vänta allt längre innan nästa försök"""
+        fail_count = previous_state.get("fail_count", 0) + 1
+        
+        # Enstaka fel pausar inget; från FAILURES_BEFORE_PAUSE fel i rad
+        # pausas 1, 2, 4 ... kontrollintervall (högst MAX_BACKOFF_SECONDS)
+        backoff = 0
+        if fail_count >= FAILURES_BEFORE_PAUSE:
+            backoff = min(self.poll_seconds * 2 ** (fail_count - FAILURES_BEFORE_PAUSE), MAX_BACKOFF_SECONDS)
+        # Bad SL oss vänta (Retry-After) gäller det alltid
+        if self.retry_after:
+            backoff = max(backoff, min(self.retry_after, MAX_BACKOFF_SECONDS))
+        
+        state = dict(previous_state)
+        state["fail_count"] = fail_count
+        if backoff:
+            state["skip_until"] = time.time() + backoff
+        else:
+            state.pop("skip_until", None)
+        self._write_state(state)
+        
+        return state.get("skip_until")
+    
+    def _write_state(self, state):
+        """Skriv tillståndet atomiskt till fil"""
         try:
             STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
-            with open(STATE_FILE, "w", encoding="utf-8") as f:
-                json.dump(state, f, ensure_ascii=False, indent=2)
+            # Skriv till temporär fil och byt namn så att filen aldrig blir halvskriven
+            tmp_file = STATE_FILE.with_suffix(".json.tmp")
+            if orjson:
+                payload = orjson.dumps(state, option=orjson.OPT_INDENT_2)
+            else:
+                payload = json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8")
+            tmp_file.write_bytes(payload)
+            os.replace(tmp_file, STATE_FILE)
         except Exception as e:
             self.log(f"⚠️ Kunde inte spara tillstånd: {e}")
     
@@ -122,12 +289,18 @@ class SLMonitorUltraSimple:
         email_to = os.environ.get("EMAIL_TO")
         email_password = os.environ.get("EMAIL_PASSWORD")
         smtp_server = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
-        smtp_port = int(os.environ.get("SMTP_PORT", "587"))
+        smtp_port = int(os.environ.get("SMTP_PORT", "465"))
         
         if not all([email_from, email_to, email_password]):
             self.log("ℹ️ Email inte konfigurerat")
             return False
         
+        # Importeras först här - de flesta körningar skickar inget email
+        import smtplib
+        import ssl
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+        
         try:
             msg = MIMEMultipart()
             msg["From"] = email_from
@@ -137,11 +310,25 @@ class SLMonitorUltraSimple:
             msg.attach(MIMEText(body, "plain", "utf-8"))
             
             self.log(f"Skickar email till {email_to}...")
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            server.starttls()
-            server.login(email_from, email_password)
+            server = self._smtp
+            if server is not None:
+                try:
+                    server.noop()
+                except (smtplib.SMTPException, OSError):
+                    # Servern har stängt anslutningen - logga in på nytt
+                    server = self._smtp = None
+            
+            if server is None:
+                if smtp_port == 465:
+                    # Implicit TLS - sparar STARTTLS-rundan
+                    server = smtplib.SMTP_SSL(smtp_server, smtp_port, context=ssl.create_default_context())
+                else:
+                    server = smtplib.SMTP(smtp_server, smtp_port)
+                    server.starttls(context=ssl.create_default_context())
+                server.login(email_from, email_password)
+                self._smtp = server
+            
             server.send_message(msg)
-            server.quit()
             
             self.log("📧 Email skickat!")
             return True
@@ -150,22 +337,46 @@ class SLMonitorUltraSimple:
             self.log(f"⚠️ Kunde inte skicka email: {str(e)[:100]}")
             return False
     
+    def close(self):
+        """Stäng öppna anslutningar (SMTP och HTTP)"""
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+        self.session.close()
+    
     def run(self):
         """Huvudloop - kontrollera trafikläget"""
         self.log("=" * 70)
         self.log(f"🚌 SL Monitor - Linje {LINE_TO_MONITOR} ({LINE_NAME})")
         self.log("=" * 70)
         
+        # Ladda tidigare tillstånd
+        previous_state = self.load_previous_state()
+        
+        # SL har inte svarat på senaste försöken - ge sidan lite vila
+        skip_until = previous_state.get("skip_until", 0)
+        if time.time() < skip_until:
+            resume = datetime.fromtimestamp(skip_until).strftime("%Y-%m-%d %H:%M:%S")
+            self.log(f"⏸️ Hoppar över kontrollen efter {previous_state.get('fail_count', 0)} misslyckade försök (pausat till {resume})")
+            self.log("=" * 70)
+            return
+        
         # Hämta nuvarande status
-        result = self.check_for_disruptions()
+        result = self.check_for_disruptions(previous_state)
         
         if result is None:
-            self.log("⚠️ Kunde inte hämta data från SL. Försöker igen nästa gång.")
+            skip_until = self.record_failure(previous_state)
+            if skip_until:
+                resume = datetime.fromtimestamp(skip_until).strftime("%Y-%m-%d %H:%M:%S")
+                self.log(f"⚠️ Kunde inte hämta data från SL. Nästa försök tidigast {resume}.")
+            else:
+                self.log("⚠️ Kunde inte hämta data från SL. Försöker igen nästa gång.")
             self.log("=" * 70)
             return
         
-        # Ladda tidigare tillstånd
-        previous_state = self.load_previous_state()
         had_disruption_before = previous_state.get("had_disruption", False)
         has_disruption_now = result.get("has_disruption", False)
         
@@ -175,16 +386,16 @@ class SLMonitorUltraSimple:
             self.log("🆕 NY STÖRNING UPPTÄCKT!")
             
             subject = f"⚠️ Störning på linje {LINE_TO_MONITOR} ({LINE_NAME})"
-            body = f"Störning upptäckt på linje {LINE_TO_MONITOR} - {LINE_NAME}\n\n"
+            parts = [f"Störning upptäckt på linje {LINE_TO_MONITOR} - {LINE_NAME}\n\n"]
             
             if result.get("context"):
-                body += "Information från SL:\n"
-                for ctx in result["context"]:
-                    body += f"- {ctx}\n"
-                body += "\n"
+                parts.append("Information från SL:\n")
+                parts.extend(f"- {ctx}\n" for ctx in result["context"])
+                parts.append("\n")
             
-            body += f"Kontrollera: {self.url}\n\n"
-            body += f"Upptäckt: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            parts.append(f"Kontrollera: {self.url}\n\n")
+            parts.append(f"Upptäckt: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            body = "".join(parts)
             
             self.send_email_notification(subject, body)
             
@@ -209,11 +420,27 @@ class SLMonitorUltraSimple:
             self.log(f"✅ Inga störningar på linje {LINE_TO_MONITOR}")
         
         # Spara nuvarande tillstånd
-        self.save_state(has_disruption_now)
+        self.save_state(has_disruption_now, result.get("cache"), previous_state)
         
         self.log("✓ Kontroll slutförd")
         self.log("=" * 70)
 
 if __name__ == "__main__":
-    monitor = SLMonitorUltraSimple()
-    monitor.run()
+    # Sätt CHECK_INTERVAL_MINUTES för att köra i en loop i samma process
+    # (varma HTTP/SMTP-anslutningar). Utan den körs en enda kontroll, som i GitHub Actions.
+    interval = float(os.environ.get("CHECK_INTERVAL_MINUTES", "0")) * 60
+    monitor = SLMonitorUltraSimple(interval if interval > 0 else POLL_SECONDS)
+    
+    try:
+        next_run = time.monotonic()
+        while True:
+            monitor.run()
+            if interval <= 0:
+                break
+            # Fast takt; tar en körning längre än intervallet körs nästa direkt (inga överlapp)
+            next_run = max(next_run + interval, time.monotonic())
+            time.sleep(max(0, next_run - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()